@@ -3,73 +3,127 @@
 
 from __future__ import annotations
 
+import contextlib
 import csv
+import functools
 import io
+import itertools
 import logging
+import logging.handlers
 import os
+import queue
 import sqlite3
+import sys
 import threading
 import time
-from datetime import datetime, timedelta
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
+import requests
 import telebot
-from telebot import types
+from requests.adapters import HTTPAdapter
+from telebot import apihelper, types
 from telebot.apihelper import ApiTelegramException
+from urllib3.util.retry import Retry
 
 
 MAX_LOG_LEN = 400
 
 
 def _clip(text: Optional[str]) -> str:
-    if text is None:
+    if not text:
         return ""
-    sanitized = text.replace("\n", "\\n")
-    if len(sanitized) <= MAX_LOG_LEN:
-        return sanitized
-    return sanitized[:MAX_LOG_LEN] + "…"
+    if "\n" in text:
+        text = text.replace("\n", "\\n")
+    if len(text) <= MAX_LOG_LEN:
+        return text
+    return text[:MAX_LOG_LEN] + "…"
+
+
+def _info_enabled() -> bool:
+    return logging.getLogger().isEnabledFor(logging.INFO)
+
+
+_OUTBOUND_FORMATTERS: Dict[str, Callable[[Any], Any]] = {
+    "text": lambda value: _clip(str(value)) if value is not None else "",
+    "photo": lambda value: str(value)[:60],
+    "document": lambda value: getattr(value, "name", getattr(value, "filename", "document")),
+}
+
+
+class _OutboundPayload:
+    __slots__ = ("fields",)
+
+    def __init__(self, fields: Dict[str, Any]) -> None:
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return str(
+            {
+                key: _OUTBOUND_FORMATTERS[key](value) if key in _OUTBOUND_FORMATTERS else value
+                for key, value in self.fields.items()
+            }
+        )
 
 
 class LoggingTeleBot(telebot.TeleBot):
-    def _log_outbound(self, method: str, payload: Dict[str, Any]) -> None:
-        logging.info("-> %s %s", method, payload)
+    def __init__(self, *args: Any, user_workers: int = 1, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._user_executors = tuple(
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"user-worker-{index}")
+            for index in range(max(user_workers, 1))
+        )
+
+    def _exec_task(self, task: Callable[..., Any], *args: Any, **kwargs: Any) -> None:
+        user = getattr(args[0], "from_user", None) if args else None
+        if user is None or not self.threaded:
+            super()._exec_task(task, *args, **kwargs)
+            return
+        executor = self._user_executors[user.id % len(self._user_executors)]
+        executor.submit(self._run_user_task, task, *args, **kwargs)
+
+    def _run_user_task(self, task: Callable[..., Any], *args: Any, **kwargs: Any) -> None:
+        try:
+            task(*args, **kwargs)
+        except Exception as exc:
+            if self.exception_handler:
+                self.exception_handler.handle(exc)
+            else:
+                logging.exception("Update handler failed")
+
+    def _log_outbound(self, method: str, **fields: Any) -> None:
+        logging.info("-> %s %s", method, _OutboundPayload(fields))
 
     def send_message(self, chat_id: Any, text: Any, *args: Any, **kwargs: Any) -> Any:
-        self._log_outbound("send_message", {"chat_id": chat_id, "text": _clip(str(text))})
+        self._log_outbound("send_message", chat_id=chat_id, text=text)
         return super().send_message(chat_id, text, *args, **kwargs)
 
     def edit_message_text(self, text: Any, chat_id: Any, message_id: Any, *args: Any, **kwargs: Any) -> Any:
-        self._log_outbound(
-            "edit_message_text",
-            {"chat_id": chat_id, "message_id": message_id, "text": _clip(str(text))},
-        )
+        self._log_outbound("edit_message_text", chat_id=chat_id, message_id=message_id, text=text)
         return super().edit_message_text(text, chat_id, message_id, *args, **kwargs)
 
     def edit_message_reply_markup(self, chat_id: Any, message_id: Any, *args: Any, **kwargs: Any) -> Any:
-        self._log_outbound(
-            "edit_message_reply_markup",
-            {"chat_id": chat_id, "message_id": message_id},
-        )
+        self._log_outbound("edit_message_reply_markup", chat_id=chat_id, message_id=message_id)
         return super().edit_message_reply_markup(chat_id, message_id, *args, **kwargs)
 
     def send_document(self, chat_id: Any, document: Any, *args: Any, **kwargs: Any) -> Any:
-        name = getattr(document, "name", getattr(document, "filename", "document"))
-        self._log_outbound("send_document", {"chat_id": chat_id, "document": name})
+        self._log_outbound("send_document", chat_id=chat_id, document=document)
         return super().send_document(chat_id, document, *args, **kwargs)
 
     def send_photo(self, chat_id: Any, photo: Any, *args: Any, **kwargs: Any) -> Any:
-        self._log_outbound("send_photo", {"chat_id": chat_id, "photo": str(photo)[:60]})
+        self._log_outbound("send_photo", chat_id=chat_id, photo=photo)
         return super().send_photo(chat_id, photo, *args, **kwargs)
 
     def answer_callback_query(self, callback_query_id: Any, text: Optional[str] = None, *args: Any, **kwargs: Any) -> Any:
-        self._log_outbound(
-            "answer_callback_query",
-            {"callback_query_id": callback_query_id, "text": _clip(text) if text else ""},
-        )
+        self._log_outbound("answer_callback_query", callback_query_id=callback_query_id, text=text)
         return super().answer_callback_query(callback_query_id, text=text, *args, **kwargs)
 
 
 def log_updates(updates: List[Any]) -> None:
+    if not _info_enabled():
+        return
     for update in updates:
         message = getattr(update, "message", None)
         if isinstance(message, types.Message):
@@ -92,66 +146,139 @@ def log_updates(updates: List[Any]) -> None:
 
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "ВПИШИ ТОКЕН")
 
+BOT_WORKERS = int(os.environ.get("FINANCE_TRACKER_WORKERS", "8"))
+
 DB_PATH = os.environ.get(
     "FINANCE_TRACKER_DB",
     os.path.join(os.path.dirname(__file__), "finance_tracker.sqlite3"),
 )
 
 
+SQLITE_PRAGMAS = """
+PRAGMA foreign_keys = ON;
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+PRAGMA temp_store = MEMORY;
+PRAGMA cache_size = -20000;
+PRAGMA mmap_size = 268435456;
+PRAGMA busy_timeout = 5000;
+"""
+
+
+SQL_CACHED_STATEMENTS = 512
+
+SQL_UPSERT_USER = (
+    "INSERT INTO users (user_id, username, first_name, last_name, created_at) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, first_name = excluded.first_name, last_name = excluded.last_name"
+)
+SQL_INSERT_TX = "INSERT INTO transactions (user_id, type, category, amount, comment, created_at) VALUES (?, ?, ?, ?, ?, ?)"
+SQL_DELETE_TX = "DELETE FROM transactions WHERE id = ? AND user_id = ?"
+SQL_FETCH_TX_BY_RANGE = (
+    "SELECT id, type, category, amount, comment, created_at FROM transactions "
+    "WHERE user_id = ? AND created_at BETWEEN ? AND ? ORDER BY created_at DESC"
+)
+SQL_FETCH_TX_BY_TYPE_RANGE = (
+    "SELECT id, type, category, amount, comment, created_at FROM transactions "
+    "WHERE user_id = ? AND type = ? AND created_at BETWEEN ? AND ? ORDER BY created_at DESC"
+)
+SQL_CATEGORY_TOTALS = (
+    "SELECT COALESCE(category, 'other') AS category, SUM(amount) AS total FROM transactions "
+    "WHERE user_id = ? AND type = ? AND created_at BETWEEN ? AND ? GROUP BY 1 ORDER BY total DESC"
+)
+SQL_BUDGET_STATUS = (
+    "SELECT budgets.amount AS budget, "
+    "(SELECT TOTAL(tx.amount) FROM transactions AS tx WHERE tx.user_id = budgets.user_id AND tx.type = 'expense' "
+    "AND tx.category = budgets.category AND tx.created_at BETWEEN ? AND ?) AS spent "
+    "FROM budgets WHERE budgets.user_id = ? AND budgets.category = ?"
+)
+SQL_UPSERT_BUDGET = (
+    "INSERT INTO budgets (user_id, category, amount) VALUES (?, ?, ?) "
+    "ON CONFLICT(user_id, category) DO UPDATE SET amount = excluded.amount"
+)
+SQL_FETCH_BUDGETS = "SELECT category, amount FROM budgets WHERE user_id = ?"
+SQL_SENT_BUDGET_ALERTS = "SELECT threshold FROM budget_alerts WHERE user_id = ? AND category = ? AND period = ?"
+SQL_INSERT_BUDGET_ALERT = (
+    "INSERT OR IGNORE INTO budget_alerts (user_id, category, period, threshold, created_at) VALUES (?, ?, ?, ?, ?)"
+)
+
+
 def get_db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn = sqlite3.connect(DB_PATH, isolation_level=None, cached_statements=SQL_CACHED_STATEMENTS)
+    conn.executescript(SQLITE_PRAGMAS)
     conn.row_factory = sqlite3.Row
     return conn
 
 
-DB = get_db()
-DB_LOCK = threading.Lock()
+_tls = threading.local()
+
+
+def get_conn() -> sqlite3.Connection:
+    conn = getattr(_tls, "conn", None)
+    if conn is None:
+        conn = get_db()
+        _tls.conn = conn
+    return conn
+
+
+@contextlib.contextmanager
+def write_transaction() -> Iterator[sqlite3.Connection]:
+    conn = get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
 
 
 def ensure_schema() -> None:
-    with DB_LOCK:
-        DB.executescript(
-            """
-            PRAGMA foreign_keys = ON;
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                created_at REAL NOT NULL
-            );
-
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
-                type TEXT NOT NULL CHECK(type IN ('expense', 'income')),
-                category TEXT,
-                amount REAL NOT NULL,
-                comment TEXT,
-                created_at REAL NOT NULL
-            );
-
-            CREATE INDEX IF NOT EXISTS idx_transactions_user_created_at
-                ON transactions(user_id, created_at DESC);
-
-            CREATE TABLE IF NOT EXISTS budgets (
-                user_id INTEGER NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
-                category TEXT NOT NULL,
-                amount REAL NOT NULL,
-                PRIMARY KEY (user_id, category)
-            );
-
-            CREATE TABLE IF NOT EXISTS budget_alerts (
-                user_id INTEGER NOT NULL,
-                category TEXT NOT NULL,
-                period TEXT NOT NULL,
-                threshold TEXT NOT NULL,
-                created_at REAL NOT NULL,
-                UNIQUE(user_id, category, period, threshold)
-            );
-            """
-        )
-        DB.commit()
+    conn = get_conn()
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            created_at REAL NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            type TEXT NOT NULL CHECK(type IN ('expense', 'income')),
+            category TEXT,
+            amount REAL NOT NULL,
+            comment TEXT,
+            created_at REAL NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_transactions_user_created_at
+            ON transactions(user_id, created_at DESC);
+
+        CREATE INDEX IF NOT EXISTS idx_transactions_user_type_created_at
+            ON transactions(user_id, type, created_at, category, amount);
+
+        CREATE TABLE IF NOT EXISTS budgets (
+            user_id INTEGER NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            category TEXT NOT NULL,
+            amount REAL NOT NULL,
+            PRIMARY KEY (user_id, category)
+        );
+
+        CREATE TABLE IF NOT EXISTS budget_alerts (
+            user_id INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            period TEXT NOT NULL,
+            threshold TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            UNIQUE(user_id, category, period, threshold)
+        );
+        """
+    )
+    conn.execute("PRAGMA optimize")
 
 
 ensure_schema()
@@ -171,16 +298,31 @@ EXPENSE_CATEGORIES: Tuple[Tuple[str, str, str], ...] = (
 
 
 CATEGORY_INFO: Dict[str, Tuple[str, str]] = {
-    key: (emoji, title) for key, emoji, title in EXPENSE_CATEGORIES
+    sys.intern(key): (sys.intern(emoji), sys.intern(title)) for key, emoji, title in EXPENSE_CATEGORIES
 }
 
 
 CATEGORY_ALIASES: Dict[str, str] = {}
 for key, emoji, title in EXPENSE_CATEGORIES:
+    key = sys.intern(key)
     CATEGORY_ALIASES[key] = key
-    CATEGORY_ALIASES[emoji] = key
-    CATEGORY_ALIASES[title.lower()] = key
-    CATEGORY_ALIASES[title.lower().replace("ё", "е")] = key
+    CATEGORY_ALIASES[sys.intern(emoji)] = key
+    CATEGORY_ALIASES[sys.intern(title.lower())] = key
+    CATEGORY_ALIASES[sys.intern(title.lower().replace("ё", "е"))] = key
+
+
+def _sql_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+SQL_RECENT_TX = (
+    "SELECT id, type, category, amount, comment, created_at, "
+    "CASE WHEN type = 'expense' THEN CASE category "
+    + " ".join(f"WHEN {_sql_literal(key)} THEN {_sql_literal(f'{emoji} {title}')}" for key, emoji, title in EXPENSE_CATEGORIES)
+    + " ELSE '✨ ' || COALESCE(category, 'Другое') END "
+    "ELSE '💰 ' || COALESCE(category, 'Доход') END AS display "
+    "FROM transactions WHERE user_id = ? ORDER BY created_at DESC LIMIT ?"
+)
 
 
 MAIN_MENU_LAYOUT: Tuple[Tuple[str, ...], ...] = (
@@ -197,186 +339,212 @@ def build_main_menu_keyboard() -> types.ReplyKeyboardMarkup:
     return markup
 
 
+MAIN_MENU_MARKUP = build_main_menu_keyboard()
+
+
 def send_with_main_menu(chat_id: int, text: str, **kwargs: Any) -> Any:
-    kwargs.setdefault("reply_markup", build_main_menu_keyboard())
+    kwargs.setdefault("reply_markup", MAIN_MENU_MARKUP)
     return bot.send_message(chat_id, text, **kwargs)
 
 
-bot = LoggingTeleBot(BOT_TOKEN, parse_mode="HTML")
+def build_http_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=max(BOT_WORKERS, 1) + 2,
+        max_retries=Retry(total=3, backoff_factor=0.1),
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+apihelper.session = build_http_session()
+
+bot = LoggingTeleBot(BOT_TOKEN, parse_mode="HTML", threaded=True, num_threads=1, user_workers=BOT_WORKERS)
 bot.set_update_listener(log_updates)
 
-bot.set_my_commands(
-    [
-        types.BotCommand("start", "Начать работу"),
-        types.BotCommand("help", "Справка"),
-        types.BotCommand("add", "Добавить расход"),
-        types.BotCommand("income", "Добавить доход"),
-        types.BotCommand("today", "Статистика за сегодня"),
-        types.BotCommand("week", "Статистика за 7 дней"),
-        types.BotCommand("month", "Статистика за месяц"),
-        types.BotCommand("history", "История транзакций"),
-        types.BotCommand("set_budget", "Установить бюджет"),
-        types.BotCommand("goals", "Прогресс по бюджетам"),
-        types.BotCommand("export", "Экспорт CSV"),
-    ]
+BOT_COMMANDS: Tuple[Tuple[str, str], ...] = (
+    ("start", "Начать работу"),
+    ("help", "Справка"),
+    ("add", "Добавить расход"),
+    ("income", "Добавить доход"),
+    ("today", "Статистика за сегодня"),
+    ("week", "Статистика за 7 дней"),
+    ("month", "Статистика за месяц"),
+    ("history", "История транзакций"),
+    ("set_budget", "Установить бюджет"),
+    ("goals", "Прогресс по бюджетам"),
+    ("export", "Экспорт CSV"),
 )
 
 
-pending_steps: Dict[int, Dict[str, Any]] = {}
+bot.set_my_commands([types.BotCommand(command, description) for command, description in BOT_COMMANDS])
+
+
+class StepPayload:
+    __slots__ = ("category", "amount", "comment_prompt_id")
+
+    def __init__(self, category: str = "other", amount: float = 0.0, comment_prompt_id: Optional[int] = None) -> None:
+        self.category = category
+        self.amount = amount
+        self.comment_prompt_id = comment_prompt_id
+
+
+PENDING_STEP_TTL = 3600
+MAX_PENDING_STEPS = 10_000
+
+pending_steps: "OrderedDict[int, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_pending_steps_guard = threading.Lock()
 
 
 def now_ts() -> float:
     return time.time()
 
 
+known_users: Dict[int, Tuple[Optional[str], Optional[str], Optional[str]]] = {}
+
+
 def ensure_user(message: types.Message) -> None:
     user = message.from_user
-    with DB_LOCK:
-        row = DB.execute("SELECT 1 FROM users WHERE user_id = ?", (user.id,)).fetchone()
-        if row:
-            DB.execute(
-                "UPDATE users SET username = ?, first_name = ?, last_name = ? WHERE user_id = ?",
-                (user.username, user.first_name, user.last_name, user.id),
-            )
-        else:
-            DB.execute(
-                "INSERT INTO users (user_id, username, first_name, last_name, created_at) VALUES (?, ?, ?, ?, ?)",
-                (user.id, user.username, user.first_name, user.last_name, now_ts()),
-            )
-        DB.commit()
+    profile = (user.username, user.first_name, user.last_name)
+    if known_users.get(user.id) == profile:
+        return
+    with write_transaction() as conn:
+        conn.execute(SQL_UPSERT_USER, (user.id, *profile, now_ts()))
+    known_users[user.id] = profile
 
 
-def set_step(user_id: int, action: str, payload: Optional[Dict[str, Any]] = None) -> None:
-    pending_steps[user_id] = {"action": action, "payload": payload or {}}
+def set_step(user_id: int, action: str, payload: Optional[StepPayload] = None) -> None:
+    entry = (now_ts(), {"action": action, "payload": payload or StepPayload()})
+    with _pending_steps_guard:
+        pending_steps[user_id] = entry
+        pending_steps.move_to_end(user_id)
+        while len(pending_steps) > MAX_PENDING_STEPS:
+            pending_steps.popitem(last=False)
 
 
 def pop_step(user_id: int) -> Optional[Dict[str, Any]]:
-    return pending_steps.pop(user_id, None)
+    with _pending_steps_guard:
+        entry = pending_steps.pop(user_id, None)
+    if entry is None or now_ts() - entry[0] > PENDING_STEP_TTL:
+        return None
+    return entry[1]
 
 
 def get_step(user_id: int) -> Optional[Dict[str, Any]]:
-    return pending_steps.get(user_id)
+    entry = pending_steps.get(user_id)
+    if entry is None:
+        return None
+    if now_ts() - entry[0] > PENDING_STEP_TTL:
+        with _pending_steps_guard:
+            if pending_steps.get(user_id) is entry:
+                del pending_steps[user_id]
+        return None
+    return entry[1]
 
 
-def parse_amount(value: str) -> float:
-    normalized = value.replace(" ", "").replace(",", ".")
-    amount = float(normalized)
-    if amount <= 0:
-        raise ValueError("amount must be positive")
-    return round(amount, 2)
+MAX_AMOUNT_DIGITS = 12
+
+_AMOUNT_TRANSLATION = str.maketrans({",": ".", " ": None, "\u00a0": None, "\u202f": None})
+
+
+def parse_amount(value: str) -> Optional[float]:
+    integer, _, fraction = value.translate(_AMOUNT_TRANSLATION).partition(".")
+    if integer.startswith("+"):
+        integer = integer[1:]
+    if not integer and not fraction:
+        return None
+    for part in (integer, fraction):
+        if part and not (part.isascii() and part.isdigit()):
+            return None
+    if len(integer.lstrip("0")) > MAX_AMOUNT_DIGITS:
+        return None
+    amount = round(float(f"{integer or '0'}.{fraction or '0'}"), 2)
+    return amount if amount > 0 else None
 
 
 def insert_transaction(user_id: int, tx_type: str, category: Optional[str], amount: float, comment: Optional[str]) -> int:
-    with DB_LOCK:
-        cur = DB.execute(
-            "INSERT INTO transactions (user_id, type, category, amount, comment, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-            (user_id, tx_type, category, amount, comment, now_ts()),
-        )
-        DB.commit()
+    with write_transaction() as conn:
+        cur = conn.execute(SQL_INSERT_TX, (user_id, tx_type, category, amount, comment, now_ts()))
         return cur.lastrowid
 
 
 def delete_transaction(user_id: int, tx_id: int) -> bool:
-    with DB_LOCK:
-        cur = DB.execute("DELETE FROM transactions WHERE id = ? AND user_id = ?", (tx_id, user_id))
-        DB.commit()
+    with write_transaction() as conn:
+        cur = conn.execute(SQL_DELETE_TX, (tx_id, user_id))
         return cur.rowcount > 0
 
 
-def fetch_transactions(user_id: int, start_ts: Optional[float], end_ts: Optional[float], tx_type: Optional[str] = None) -> List[sqlite3.Row]:
-    query = ["SELECT id, type, category, amount, comment, created_at FROM transactions WHERE user_id = ?"]
-    params: List[Any] = [user_id]
+def build_transactions_query(user_id: int, start_ts: Optional[float], end_ts: Optional[float], tx_type: Optional[str] = None) -> Tuple[str, Tuple[Any, ...]]:
+    start = start_ts if start_ts is not None else float("-inf")
+    end = end_ts if end_ts is not None else float("inf")
     if tx_type:
-        query.append("AND type = ?")
-        params.append(tx_type)
-    if start_ts is not None:
-        query.append("AND created_at >= ?")
-        params.append(start_ts)
-    if end_ts is not None:
-        query.append("AND created_at <= ?")
-        params.append(end_ts)
-    query.append("ORDER BY created_at DESC")
-    with DB_LOCK:
-        return DB.execute(" ".join(query), tuple(params)).fetchall()
+        return SQL_FETCH_TX_BY_TYPE_RANGE, (user_id, tx_type, start, end)
+    return SQL_FETCH_TX_BY_RANGE, (user_id, start, end)
+
+
+def iter_transaction_batches(
+    user_id: int,
+    start_ts: Optional[float],
+    end_ts: Optional[float],
+    tx_type: Optional[str] = None,
+    batch_size: int = 1000,
+) -> Iterator[List[sqlite3.Row]]:
+    sql, params = build_transactions_query(user_id, start_ts, end_ts, tx_type)
+    cursor = get_conn().execute(sql, params)
+    try:
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                return
+            yield batch
+    finally:
+        cursor.close()
+
+
+def fetch_category_totals(user_id: int, start_ts: float, end_ts: float, tx_type: str = "expense") -> List[sqlite3.Row]:
+    return get_conn().execute(SQL_CATEGORY_TOTALS, (user_id, tx_type, start_ts, end_ts)).fetchall()
 
 
 def fetch_recent_transactions(user_id: int, limit: int = 10) -> List[sqlite3.Row]:
-    with DB_LOCK:
-        return DB.execute(
-            "SELECT id, type, category, amount, comment, created_at FROM transactions WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
-            (user_id, limit),
-        ).fetchall()
+    return get_conn().execute(SQL_RECENT_TX, (user_id, limit)).fetchall()
 
 
 def upsert_budget(user_id: int, category: str, amount: float) -> None:
-    with DB_LOCK:
-        DB.execute(
-            "INSERT INTO budgets (user_id, category, amount) VALUES (?, ?, ?) ON CONFLICT(user_id, category) DO UPDATE SET amount = excluded.amount",
-            (user_id, category, amount),
-        )
-        DB.commit()
+    with write_transaction() as conn:
+        conn.execute(SQL_UPSERT_BUDGET, (user_id, category, amount))
 
 
 def fetch_budgets(user_id: int) -> List[sqlite3.Row]:
-    with DB_LOCK:
-        return DB.execute("SELECT category, amount FROM budgets WHERE user_id = ?", (user_id,)).fetchall()
-
-
-def get_budget(user_id: int, category: str) -> Optional[float]:
-    with DB_LOCK:
-        row = DB.execute("SELECT amount FROM budgets WHERE user_id = ? AND category = ?", (user_id, category)).fetchone()
-    return row["amount"] if row else None
-
+    return get_conn().execute(SQL_FETCH_BUDGETS, (user_id,)).fetchall()
 
-def budget_alert_sent(user_id: int, category: str, period: str, threshold: str) -> bool:
-    with DB_LOCK:
-        row = DB.execute(
-            "SELECT 1 FROM budget_alerts WHERE user_id = ? AND category = ? AND period = ? AND threshold = ?",
-            (user_id, category, period, threshold),
-        ).fetchone()
-    return bool(row)
 
-
-def mark_budget_alert(user_id: int, category: str, period: str, threshold: str) -> None:
-    with DB_LOCK:
-        DB.execute(
-            "INSERT OR IGNORE INTO budget_alerts (user_id, category, period, threshold, created_at) VALUES (?, ?, ?, ?, ?)",
-            (user_id, category, period, threshold, now_ts()),
-        )
-        DB.commit()
+def local_midnight_ts(year: int, month: int, day: int) -> float:
+    return time.mktime((year, month, day, 0, 0, 0, 0, 0, -1))
 
 
-def start_of_day(dt: datetime) -> datetime:
-    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+def day_bounds_ts(now: float, days: int = 1) -> Tuple[float, float]:
+    lt = time.localtime(now)
+    start = local_midnight_ts(lt.tm_year, lt.tm_mon, lt.tm_mday - days + 1)
+    end = local_midnight_ts(lt.tm_year, lt.tm_mon, lt.tm_mday + 1) - 0.001
+    return start, end
 
 
-def end_of_day(dt: datetime) -> datetime:
-    return dt.replace(hour=23, minute=59, second=59, microsecond=999000)
+def month_bounds_ts(year: int, month: int) -> Tuple[float, float]:
+    return local_midnight_ts(year, month, 1), local_midnight_ts(year, month + 1, 1) - 0.001
 
 
-def month_bounds(dt: datetime) -> Tuple[datetime, datetime]:
-    start = dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    if dt.month == 12:
-        end_month = start.replace(year=dt.year + 1, month=1)
-    else:
-        end_month = start.replace(month=dt.month + 1)
-    end = end_month - timedelta(microseconds=1000)
-    return start, end
+def aggregate_by_category(rows: Iterable[sqlite3.Row]) -> Dict[str, float]:
+    return {row["category"]: float(row["total"]) for row in rows}
 
 
-def aggregate_by_category(rows: Iterable[sqlite3.Row]) -> Dict[str, float]:
-    totals: Dict[str, float] = {}
-    for row in rows:
-        category = row["category"] or "other"
-        totals[category] = totals.get(category, 0.0) + float(row["amount"])
-    return totals
+_BARS: Tuple[str, ...] = tuple("█" * blocks for blocks in range(21))
 
 
 def render_bar(percent: float) -> str:
     if percent <= 0:
-        return ""
-    blocks = max(1, int(percent // 5))
-    return "█" * min(blocks, 20)
+        return _BARS[0]
+    return _BARS[min(20, max(1, int(percent // 5)))]
 
 
 def format_category_line(category: str, amount: float, percent: float) -> str:
@@ -386,16 +554,16 @@ def format_category_line(category: str, amount: float, percent: float) -> str:
 
 
 def summarize_period(message: types.Message, label: str, start_ts: float, end_ts: float) -> None:
-    rows = fetch_transactions(message.from_user.id, start_ts, end_ts, tx_type="expense")
+    rows = fetch_category_totals(message.from_user.id, start_ts, end_ts)
     if not rows:
         send_with_main_menu(message.chat.id, f"Нет расходов за {label}.")
         return
-    totals = aggregate_by_category(rows)
-    total_amount = sum(totals.values())
+    total_amount = sum(row["total"] for row in rows)
     lines = [f"<b>Расходы за {label}</b>"]
-    for category, amount in sorted(totals.items(), key=lambda item: item[1], reverse=True):
+    for row in rows:
+        amount = row["total"]
         percent = (amount / total_amount) * 100 if total_amount else 0
-        lines.append(format_category_line(category, amount, percent))
+        lines.append(format_category_line(row["category"], amount, percent))
     if label == "месяц":
         days_in_period = max(1, (datetime.fromtimestamp(end_ts) - datetime.fromtimestamp(start_ts)).days + 1)
         avg = total_amount / days_in_period
@@ -405,26 +573,37 @@ def summarize_period(message: types.Message, label: str, start_ts: float, end_ts
     send_with_main_menu(message.chat.id, "\n".join(lines))
 
 
-def check_budget_thresholds(user_id: int, category: str, chat_id: int) -> None:
-    budget = get_budget(user_id, category)
-    if not budget:
-        return
+def check_budget_thresholds(conn: sqlite3.Connection, user_id: int, category: str) -> List[str]:
+    lt = time.localtime(now_ts())
+    start, end = month_bounds_ts(lt.tm_year, lt.tm_mon)
+    status = conn.execute(SQL_BUDGET_STATUS, (start, end, user_id, category)).fetchone()
+    if not status or not status["budget"] or status["spent"] <= 0:
+        return []
+    budget, spent = status["budget"], status["spent"]
+    period = f"{lt.tm_year:04d}-{lt.tm_mon:02d}"
+    sent = {row["threshold"] for row in conn.execute(SQL_SENT_BUDGET_ALERTS, (user_id, category, period))}
+    crossed = [
+        threshold_name
+        for threshold_value, threshold_name in ((0.8, "80"), (1.0, "100"))
+        if spent >= budget * threshold_value and threshold_name not in sent
+    ]
+    if not crossed:
+        return []
+    created_at = now_ts()
+    conn.executemany(
+        SQL_INSERT_BUDGET_ALERT,
+        [(user_id, category, period, threshold, created_at) for threshold in crossed],
+    )
     emoji, title = CATEGORY_INFO.get(category, ("✨", category))
-    now = datetime.now()
-    start, end = month_bounds(now)
-    rows = fetch_transactions(user_id, start.timestamp(), end.timestamp(), tx_type="expense")
-    spent = sum(float(row["amount"]) for row in rows if row["category"] == category)
-    if spent <= 0:
-        return
-    period = start.strftime("%Y-%m")
-    for threshold_value, threshold_name in ((0.8, "80"), (1.0, "100")):
-        if spent >= budget * threshold_value and not budget_alert_sent(user_id, category, period, threshold_name):
-            mark_budget_alert(user_id, category, period, threshold_name)
-            percent = min(100, (spent / budget) * 100)
-            bot.send_message(
-                chat_id,
-                f"⚠️ {emoji} {title}: израсходовано {spent:.2f}₽ ({percent:.0f}% от бюджета {budget:.2f}₽)",
-            )
+    percent = min(100, (spent / budget) * 100)
+    text = f"⚠️ {emoji} {title}: израсходовано {spent:.2f}₽ ({percent:.0f}% от бюджета {budget:.2f}₽)"
+    return [text] * len(crossed)
+
+
+def record_expense(user_id: int, category: str, amount: float, comment: Optional[str]) -> List[str]:
+    with write_transaction() as conn:
+        conn.execute(SQL_INSERT_TX, (user_id, "expense", category, amount, comment, now_ts()))
+        return check_budget_thresholds(conn, user_id, category)
 
 
 def build_categories_keyboard(action: str) -> types.InlineKeyboardMarkup:
@@ -439,6 +618,9 @@ def build_categories_keyboard(action: str) -> types.InlineKeyboardMarkup:
     return markup
 
 
+EXPENSE_CATEGORIES_MARKUP = build_categories_keyboard("add_expense")
+
+
 def refresh_history_message(user_id: int, chat_id: int, message_id: int) -> None:
     rows = fetch_recent_transactions(user_id)
     text, markup = build_history_view(rows)
@@ -446,74 +628,67 @@ def refresh_history_message(user_id: int, chat_id: int, message_id: int) -> None
 
 
 def build_history_view(rows: Iterable[sqlite3.Row]) -> Tuple[str, Optional[types.InlineKeyboardMarkup]]:
-    lines = ["<b>Последние операции</b>"]
+    buf = io.StringIO()
+    write = buf.write
+    write("<b>Последние операции</b>")
     markup = types.InlineKeyboardMarkup(row_width=1) if rows else None
+    fromtimestamp = datetime.fromtimestamp
     for row in rows:
-        dt = datetime.fromtimestamp(row["created_at"]).strftime("%d.%m %H:%M")
-        amount = float(row["amount"])
-        if row["type"] == "expense":
-            emoji, title = CATEGORY_INFO.get(row["category"], ("✨", row["category"] or "Другое"))
-            prefix = "-"
-            category_text = f"{emoji} {title}"
-        else:
-            prefix = "+"
-            category_text = f"💰 {row['category'] or 'Доход'}"
-        comment = row["comment"] or ""
-        comment_suffix = f" — {comment}" if comment else ""
-        lines.append(f"{dt} • {category_text} • {prefix}{amount:.2f}₽{comment_suffix}")
+        write("\n")
+        write(fromtimestamp(row["created_at"]).strftime("%d.%m %H:%M"))
+        write(" • ")
+        write(row["display"])
+        write(" • -" if row["type"] == "expense" else " • +")
+        write(format(float(row["amount"]), ".2f"))
+        write("₽")
+        comment = row["comment"]
+        if comment:
+            write(" — ")
+            write(comment)
         if markup:
-            markup.add(
-                types.InlineKeyboardButton(
-                    text=f"Удалить {int(row['id'])}",
-                    callback_data=f"delete_tx:{int(row['id'])}",
-                )
-            )
-    if len(lines) == 1:
-        lines.append("Записей пока нет.")
-    return "\n".join(lines), markup
+            tx_id = int(row["id"])
+            markup.add(types.InlineKeyboardButton(text=f"Удалить {tx_id}", callback_data=f"delete_tx:{tx_id}"))
+    if not rows:
+        write("\nЗаписей пока нет.")
+    return buf.getvalue(), markup
 
 
 def start_expense_flow(message: types.Message) -> None:
     ensure_user(message)
-    markup = build_categories_keyboard("add_expense")
     bot.send_message(
         message.chat.id,
         "<b>Добавление расхода</b>\n1. Выберите категорию ниже.\n2. Введите сумму (например, 450).\n3. Добавьте комментарий при необходимости.",
-        reply_markup=markup,
+        reply_markup=EXPENSE_CATEGORIES_MARKUP,
     )
 
 
 def start_income_flow(message: types.Message) -> None:
     ensure_user(message)
-    set_step(message.from_user.id, "income_amount", {})
+    set_step(message.from_user.id, "income_amount")
     bot.send_message(
         message.chat.id,
         "<b>Добавление дохода</b>\nВведите сумму (например, 2500), затем укажите источник дохода.",
-        reply_markup=build_main_menu_keyboard(),
+        reply_markup=MAIN_MENU_MARKUP,
     )
 
 
 def show_today_stats(message: types.Message) -> None:
     ensure_user(message)
-    today = datetime.now()
-    start = start_of_day(today).timestamp()
-    end = end_of_day(today).timestamp()
+    start, end = day_bounds_ts(now_ts())
     summarize_period(message, "сегодня", start, end)
 
 
 def show_week_stats(message: types.Message) -> None:
     ensure_user(message)
-    today = datetime.now()
-    start = start_of_day(today - timedelta(days=6)).timestamp()
-    end = end_of_day(today).timestamp()
+    start, end = day_bounds_ts(now_ts(), days=7)
     summarize_period(message, "неделю", start, end)
 
 
 def show_month_stats(message: types.Message) -> None:
     ensure_user(message)
-    now = datetime.now()
-    start, end = month_bounds(now)
-    summarize_period(message, "месяц", start.timestamp(), end.timestamp())
+    lt = time.localtime(now_ts())
+    start, end = month_bounds_ts(lt.tm_year, lt.tm_mon)
+    summarize_period(message, "месяц", start, end)
 
 
 def show_history(message: types.Message) -> None:
@@ -529,9 +704,9 @@ def show_goals(message: types.Message) -> None:
     if not budgets:
         send_with_main_menu(message.chat.id, "Бюджеты не заданы. Используйте /set_budget.")
         return
-    now = datetime.now()
-    start, end = month_bounds(now)
-    rows = fetch_transactions(message.from_user.id, start.timestamp(), end.timestamp(), tx_type="expense")
+    lt = time.localtime(now_ts())
+    start, end = month_bounds_ts(lt.tm_year, lt.tm_mon)
+    rows = fetch_category_totals(message.from_user.id, start, end)
     spent_by_category = aggregate_by_category(rows)
     lines = ["<b>Прогресс по бюджетам</b>"]
     for row in budgets:
@@ -572,8 +747,12 @@ def build_comment_keyboard() -> types.InlineKeyboardMarkup:
     return markup
 
 
+COMMENT_MARKUP = build_comment_keyboard()
+
+
 @bot.message_handler(commands=["start"])
 def cmd_start(message: types.Message) -> None:
+    pop_step(message.from_user.id)
     ensure_user(message)
     send_with_main_menu(
         message.chat.id,
@@ -630,6 +809,7 @@ def cmd_history(message: types.Message) -> None:
     show_history(message)
 
 
+@functools.lru_cache(maxsize=256)
 def resolve_category(name: str) -> Optional[str]:
     key = CATEGORY_ALIASES.get(name.lower())
     return key
@@ -649,9 +829,8 @@ def cmd_set_budget(message: types.Message) -> None:
     if not category:
         send_with_main_menu(message.chat.id, "Неизвестная категория. Используйте названия из /add.")
         return
-    try:
-        amount = parse_amount(parts[2])
-    except ValueError:
+    amount = parse_amount(parts[2])
+    if amount is None:
         send_with_main_menu(message.chat.id, "Сумма должна быть положительным числом.")
         return
     upsert_budget(message.from_user.id, category, amount)
@@ -676,16 +855,18 @@ def cmd_export(message: types.Message) -> None:
     except ValueError:
         send_with_main_menu(message.chat.id, "Неверный формат. Используйте YYYY-MM, например 2025-01.")
         return
-    start, end = month_bounds(period)
-    rows = fetch_transactions(message.from_user.id, start.timestamp(), end.timestamp(), tx_type=None)
-    if not rows:
+    start, end = month_bounds_ts(period.year, period.month)
+    batches = iter_transaction_batches(message.from_user.id, start, end, tx_type=None)
+    first_batch = next(batches, None)
+    if not first_batch:
         send_with_main_menu(message.chat.id, "За выбранный месяц нет операций.")
         return
-    buffer = io.StringIO()
-    writer = csv.writer(buffer)
+    binary = io.BytesIO()
+    wrapper = io.TextIOWrapper(binary, encoding="utf-8", newline="", write_through=True)
+    writer = csv.writer(wrapper)
     writer.writerow(["id", "type", "category", "amount", "comment", "created_at"])
-    for row in rows:
-        writer.writerow(
+    for batch in itertools.chain((first_batch,), batches):
+        writer.writerows(
             [
                 row["id"],
                 row["type"],
@@ -694,11 +875,12 @@ def cmd_export(message: types.Message) -> None:
                 row["comment"] or "",
                 datetime.fromtimestamp(row["created_at"]).isoformat(sep=" ", timespec="minutes"),
             ]
+            for row in batch
         )
-    buffer.seek(0)
-    filename = f"finance_{message.from_user.id}_{start.strftime('%Y_%m')}.csv"
-    binary = io.BytesIO(buffer.getvalue().encode("utf-8"))
-    binary.name = filename
+    wrapper.flush()
+    wrapper.detach()
+    binary.seek(0)
+    binary.name = f"finance_{message.from_user.id}_{period.strftime('%Y_%m')}.csv"
     bot.send_document(message.chat.id, binary)
 
 
@@ -706,7 +888,7 @@ def cmd_export(message: types.Message) -> None:
 def cb_add_expense(call: types.CallbackQuery) -> None:
     category = call.data.split(":", 1)[1]
     emoji, title = CATEGORY_INFO.get(category, ("✨", category))
-    set_step(call.from_user.id, "expense_amount", {"category": category, "message_id": call.message.message_id, "chat_id": call.message.chat.id})
+    set_step(call.from_user.id, "expense_amount", StepPayload(category=category))
     bot.answer_callback_query(call.id, text=f"Категория: {title}")
     bot.send_message(call.message.chat.id, f"Введите сумму для {emoji} {title}:")
 
@@ -736,100 +918,115 @@ def cb_skip_comment(call: types.CallbackQuery) -> None:
     if not step or step.get("action") != "expense_comment":
         bot.answer_callback_query(call.id, "Нет ожидаемого комментария.", show_alert=True)
         return
-    payload = step.get("payload", {})
-    finalize_expense_entry(call.from_user.id, call.message.chat.id, payload, "")
+    finalize_expense_entry(call.from_user.id, call.message.chat.id, step["payload"], "")
     bot.answer_callback_query(call.id, "Комментарий пропущен")
 
 
-def handle_expense_amount(message: types.Message, payload: Dict[str, Any]) -> bool:
-    try:
-        amount = parse_amount(message.text.strip())
-    except ValueError:
-        bot.send_message(message.chat.id, "Сумма должна быть положительным числом. Попробуйте снова:")
+def handle_expense_amount(message: types.Message, text: str, payload: StepPayload) -> bool:
+    uid, cid = message.from_user.id, message.chat.id
+    amount = parse_amount(text)
+    if amount is None:
+        bot.send_message(cid, "Сумма должна быть положительным числом. Попробуйте снова:")
         return True
-    payload["amount"] = amount
+    payload.amount = amount
     prompt = bot.send_message(
-        message.chat.id,
+        cid,
         "Добавьте комментарий или нажмите кнопку, чтобы пропустить.",
-        reply_markup=build_comment_keyboard(),
+        reply_markup=COMMENT_MARKUP,
     )
-    payload["comment_prompt_id"] = prompt.message_id
-    set_step(message.from_user.id, "expense_comment", payload)
+    payload.comment_prompt_id = prompt.message_id
+    set_step(uid, "expense_comment", payload)
     return True
 
 
-def finalize_expense_entry(user_id: int, chat_id: int, payload: Dict[str, Any], comment: Optional[str]) -> None:
-    prompt_id = payload.get("comment_prompt_id")
+def finalize_expense_entry(user_id: int, chat_id: int, payload: StepPayload, comment: Optional[str]) -> None:
+    prompt_id = payload.comment_prompt_id
     if prompt_id:
         try:
             bot.edit_message_reply_markup(chat_id, prompt_id)
         except ApiTelegramException:
             pass
-    insert_transaction(user_id, "expense", payload.get("category"), payload.get("amount", 0.0), (comment or "") or None)
+    category = payload.category
+    amount = payload.amount
+    alerts = record_expense(user_id, category, amount, comment or None)
     pop_step(user_id)
-    emoji, title = CATEGORY_INFO.get(payload.get("category", "other"), ("✨", "Расход"))
-    send_with_main_menu(
-        chat_id,
-        f"Записано: {emoji} {title} — {payload.get('amount', 0.0):.2f}₽",
-    )
-    check_budget_thresholds(user_id, payload.get("category", "other"), chat_id)
+    emoji, title = CATEGORY_INFO.get(category, ("✨", "Расход"))
+    send_with_main_menu(chat_id, f"Записано: {emoji} {title} — {amount:.2f}₽")
+    for alert in alerts:
+        bot.send_message(chat_id, alert)
 
 
-def handle_expense_comment(message: types.Message, payload: Dict[str, Any]) -> bool:
-    comment = message.text.strip()
-    finalize_expense_entry(message.from_user.id, message.chat.id, payload, comment)
+def handle_expense_comment(message: types.Message, text: str, payload: StepPayload) -> bool:
+    uid, cid = message.from_user.id, message.chat.id
+    finalize_expense_entry(uid, cid, payload, text)
     return True
 
 
-def handle_income_amount(message: types.Message, payload: Dict[str, Any]) -> bool:
-    try:
-        amount = parse_amount(message.text.strip())
-    except ValueError:
-        bot.send_message(message.chat.id, "Сумма должна быть положительным числом. Попробуйте снова:")
+def handle_income_amount(message: types.Message, text: str, payload: StepPayload) -> bool:
+    uid, cid = message.from_user.id, message.chat.id
+    amount = parse_amount(text)
+    if amount is None:
+        bot.send_message(cid, "Сумма должна быть положительным числом. Попробуйте снова:")
         return True
-    payload["amount"] = amount
-    set_step(message.from_user.id, "income_source", payload)
-    bot.send_message(message.chat.id, "Укажите источник дохода (например, стипендия):")
+    payload.amount = amount
+    set_step(uid, "income_source", payload)
+    bot.send_message(cid, "Укажите источник дохода (например, стипендия):")
     return True
 
 
-def handle_income_source(message: types.Message, payload: Dict[str, Any]) -> bool:
-    source = message.text.strip() or "Доход"
-    insert_transaction(message.from_user.id, "income", source, payload.get("amount", 0.0), None)
-    pop_step(message.from_user.id)
-    send_with_main_menu(
-        message.chat.id,
-        f"Доход {source} на сумму {payload.get('amount', 0.0):.2f}₽ добавлен.",
-    )
+def handle_income_source(message: types.Message, text: str, payload: StepPayload) -> bool:
+    uid, cid = message.from_user.id, message.chat.id
+    amount = payload.amount
+    insert_transaction(uid, "income", text, amount, None)
+    pop_step(uid)
+    send_with_main_menu(cid, f"Доход {text} на сумму {amount:.2f}₽ добавлен.")
     return True
 
 
+STEP_HANDLERS: Dict[str, Callable[[types.Message, str, StepPayload], bool]] = {
+    "expense_amount": handle_expense_amount,
+    "expense_comment": handle_expense_comment,
+    "income_amount": handle_income_amount,
+    "income_source": handle_income_source,
+}
+
+
 @bot.message_handler(content_types=["text"])
 def handle_text(message: types.Message) -> None:
+    text = (message.text or "").strip()
+    if not text:
+        return
     step = get_step(message.from_user.id)
     if step:
-        action = step.get("action")
-        payload = step.get("payload", {})
-        if action == "expense_amount":
-            if handle_expense_amount(message, payload):
-                return
-        elif action == "expense_comment":
-            if handle_expense_comment(message, payload):
-                return
-        elif action == "income_amount":
-            if handle_income_amount(message, payload):
-                return
-        elif action == "income_source":
-            if handle_income_source(message, payload):
-                return
-    if message.text.startswith("/"):
-        return
+        handler = STEP_HANDLERS.get(step.get("action"))
+        if handler and handler(message, text, step["payload"]):
+            return
     send_with_main_menu(message.chat.id, "Выберите действие через кнопки ниже или используйте /help.")
 
 
+def setup_logging() -> logging.handlers.QueueListener:
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+    listener.start()
+    return listener
+
+
 def main() -> None:
-    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s %(message)s")
-    bot.infinity_polling(skip_pending=True)
+    listener = setup_logging()
+    try:
+        bot.infinity_polling(
+            skip_pending=True,
+            timeout=20,
+            long_polling_timeout=20,
+            allowed_updates=["message", "callback_query"],
+        )
+    finally:
+        listener.stop()
 
 
 if __name__ == "__main__":